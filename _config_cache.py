@@ -0,0 +1,33 @@
+"""Memoized loader for stashplexagent.config.
+
+Every module that builds its own ConfigParser pays the disk read and INI
+parse again. Parse once per (path, mtime) instead and hand out plain
+nested dicts, so repeat loads — including re-imports in forked/spawned
+workers that share the interpreter — are O(1) lookups.
+"""
+import configparser
+import functools
+import os
+
+
+@functools.lru_cache(maxsize=None)
+def _load(path: str, mtime_ns: int) -> dict:
+    # RawConfigParser: no %(...)s interpolation scan on reads — the config
+    # only holds literal host/port/flag values.
+    parser = configparser.RawConfigParser()
+    parser.read(path)
+    return {section: dict(parser[section]) for section in parser.sections()}
+
+
+def get_config(path: str) -> dict:
+    """Return the parsed config as {section: {key: value}}, cached by mtime.
+
+    Editing the file on disk invalidates the cache naturally because the
+    mtime changes the cache key. A missing file yields an empty dict so
+    callers can rely on their fallbacks, mirroring ConfigParser.read().
+    """
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        mtime_ns = -1
+    return _load(path, mtime_ns)
@@ -1,42 +1,126 @@
-"""Compatibility entrypoint: start the ASGI app with settings from stashplexagent.config
+"""Entrypoint: start the ASGI app with settings from stashplexagent.config
 
 Run with:
     python main.py
 
-This will read `stashplexagent.config` and start uvicorn for `stashplexagent:app`.
-"""
-import os
-import configparser
-import uvicorn
+Settings (config file plus the DEV/DEBUG env switches) are resolved once
+in the shared settings module; this launcher and any worker that imports
+the app read the same cached values instead of re-reading the
+environment or re-parsing the config per process.
 
-# Read config
-config = configparser.ConfigParser()
-config_path = os.path.join(os.path.dirname(__file__), "stashplexagent.config")
-config.read(config_path)
+Production starts a gunicorn master with uvicorn workers; DEV=true runs
+a single auto-reloading uvicorn instead.
+"""
+from settings import (
+    CPU_AFFINITY as cpu_affinity,
+    DEBUG as debug_mode,
+    DEV as dev_mode,
+    NUM_WORKERS as num_workers,
+    SERVER_HOST as server_host,
+    SERVER_PORT as server_port,
+    SERVER_UDS as server_uds,
+    WORKER_CLASS as worker_class,
+    WORKER_START_DELAY as worker_start_delay,
+)
 
-# server section name: plexagentserver
-server_host = config.get("plexagentserver", "host", fallback="0.0.0.0")
-server_port = int(config.get("plexagentserver", "port", fallback="7979"))
-num_workers = int(config.get("plexagentserver", "num_workers", fallback="2"))
+# Config names for [plexagentserver] worker_class → gunicorn worker classes
+_WORKER_CLASSES = {
+    "uvicorn": "uvicorn.workers.UvicornWorker",
+    "uvicorn_h11": "uvicorn.workers.UvicornH11Worker",
+}
 
 if __name__ == "__main__":
-    # Check for development mode
-    dev_mode = os.getenv("DEV", "false").lower() == "true"
-    debug_mode = (
-        os.getenv("DEBUG", "false").lower() == "true"
-        or config.getboolean("stash", "debug", fallback=False)
-    )
 
     if dev_mode:
-        # Development mode: single worker with auto-reload
+        # Development mode: single worker with auto-reload.
+        # uvicorn (and its fastapi/pydantic import chain) is only needed when
+        # actually serving, so defer the import to keep plain imports of this
+        # module (tooling, config introspection) cheap.
+        import uvicorn
+
         print("[DEV MODE] Starting with auto-reload enabled")
-        uvicorn.run("stashplexagent:app", host=server_host, port=server_port, reload=True)
-    else:
-        # Production mode: multiple workers, no reload, suppress access logs unless debug
+        _listen = (
+            {"uds": server_uds}
+            if server_uds
+            else {"host": server_host, "port": server_port}
+        )
         uvicorn.run(
             "stashplexagent:app",
-            host=server_host,
-            port=server_port,
-            workers=num_workers,
+            **_listen,
+            reload=True,
+            # Scope the file watcher to our own sources; watching the whole
+            # tree (venv, __pycache__, logs) burns CPU for nothing.
+            reload_includes=["*.py", "stashplexagent.config"],
+            reload_excludes=["*.pyc", "__pycache__", ".venv/*", "venv/*"],
+            reload_delay=0.5,
+            loop="uvloop",
+            http="httptools",
             access_log=debug_mode,
         )
+    else:
+        # Production mode: gunicorn master with uvicorn workers.
+        # Gunicorn's pre-fork supervisor restarts crashed workers and handles
+        # multi-core serving better than uvicorn's built-in `workers=` mode.
+        # Embedded via BaseApplication so `python main.py` stays the only
+        # entrypoint (no gunicorn binary on PATH required).
+        import os
+        import time
+
+        from gunicorn.app.base import BaseApplication
+        from gunicorn.util import import_app
+
+        def _pin_worker(worker):
+            # Keep the worker on one CPU so the scheduler stops migrating it
+            # and its L1/L2 working set stays warm. Opt-in via cpu_affinity.
+            try:
+                os.sched_setaffinity(0, {(worker.age - 1) % os.cpu_count()})
+            except (AttributeError, OSError):
+                worker.log.debug("CPU pinning unavailable on this platform")
+
+        def _post_fork(server, worker):
+            if cpu_affinity:
+                _pin_worker(worker)
+            _stagger_worker(server, worker)
+
+        def _stagger_worker(server, worker):
+            # Ramp workers up sequentially instead of importing the app in
+            # num_workers processes at once, which stalls small/contended
+            # hosts at boot. worker.age is 1-based spawn order, so the first
+            # worker starts serving immediately. age keeps counting across
+            # restarts, so only the initial boot is staggered.
+            if worker_start_delay > 0 and 1 < worker.age <= num_workers:
+                worker.log.debug("Staggering worker %s startup", worker.age)
+                time.sleep((worker.age - 1) * worker_start_delay)
+
+        class GunicornApp(BaseApplication):
+            def __init__(self, app_uri: str, options: dict):
+                self.app_uri = app_uri
+                self.options = options
+                super().__init__()
+
+            def load_config(self):
+                for key, value in self.options.items():
+                    if value is not None:
+                        self.cfg.set(key, value)
+
+            def load(self):
+                return import_app(self.app_uri)
+
+        GunicornApp(
+            "stashplexagent:app",
+            {
+                # A UDS bind skips the TCP stack for same-host reverse proxies
+                "bind": f"unix:{server_uds}" if server_uds else f"{server_host}:{server_port}",
+                "workers": num_workers,
+                "worker_class": _WORKER_CLASSES.get(
+                    worker_class, _WORKER_CLASSES["uvicorn"]
+                ),
+                # Import the app once in the master and fork; workers share
+                # the code/config pages copy-on-write instead of re-importing
+                # fastapi/pydantic per process.
+                "preload_app": True,
+                "accesslog": "-" if debug_mode else None,
+                "loglevel": "debug" if debug_mode else "warning",
+                "post_fork": _post_fork,
+            },
+        ).run()
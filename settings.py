@@ -0,0 +1,48 @@
+"""Shared parsed configuration for the agent.
+
+Importing this module parses stashplexagent.config exactly once per
+process (through _config_cache) and exposes the sections as plain dicts.
+ConfigParser's per-.get() interpolation and section lookups were the
+Radicale-style hidden cost here; plain dict access is a hash lookup.
+"""
+import os
+from pathlib import Path
+
+from _config_cache import get_config
+
+# Resolved once at import; Path.with_name is a single string operation
+# rather than the dirname+join pair, and re-imports in spawned workers
+# reuse the module-level constant.
+CONFIG_PATH = str(Path(__file__).with_name("stashplexagent.config"))
+
+CFG = get_config(CONFIG_PATH)
+
+STASH_CFG = CFG.get("stash", {})
+SERVER_CFG = CFG.get("plexagentserver", {})
+PLEX_CFG = CFG.get("plex", {})
+
+# Truthy spellings accepted for boolean switches (env or config file)
+TRUTHY = frozenset({"true", "1", "yes", "on"})
+
+# Server launch settings, shared by main.py and the app module so each is
+# resolved exactly once per process (sys.modules guarantees single import).
+SERVER_HOST = SERVER_CFG.get("host", "0.0.0.0")
+SERVER_PORT = int(SERVER_CFG.get("port", "7979"))
+NUM_WORKERS = int(os.environ.get("WORKERS", SERVER_CFG.get("num_workers", "2")))
+WORKER_START_DELAY = float(SERVER_CFG.get("worker_start_delay", "2.0"))
+# "uvicorn" (httptools parser, default) or "uvicorn_h11" (pure HTTP/1
+# worker that skips protocol auto-selection per connection)
+WORKER_CLASS = SERVER_CFG.get("worker_class", "uvicorn")
+# Optional UNIX domain socket path; when set it replaces host/port, which
+# skips the TCP stack entirely for a colocated reverse proxy.
+SERVER_UDS = SERVER_CFG.get("uds", "")
+# Pin each worker to one CPU (Linux only). Off by default: it helps cache
+# locality on dedicated hosts but confines the worker's thread pools too.
+CPU_AFFINITY = SERVER_CFG.get("cpu_affinity", "").lower() in TRUTHY
+
+# Env-var switches (env takes precedence over the config file)
+DEV = os.environ.get("DEV", "").lower() in TRUTHY
+DEBUG = (
+    os.environ.get("DEBUG", "").lower() in TRUTHY
+    or STASH_CFG.get("debug", "").lower() in TRUTHY
+)
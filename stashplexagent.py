@@ -1,752 +1,1171 @@
-import io
-import re
-import os
-import json
-import logging
-import configparser
-import time
-import requests
-import urllib.parse
-from datetime import datetime, timezone
-from fastapi import BackgroundTasks, FastAPI, Request, Response
-from PIL import Image
-
-# ---------------------------------------------------------------------------
-# Logging
-# ---------------------------------------------------------------------------
-logger = logging.getLogger("stashplexagent")
-handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
-logger.addHandler(handler)
-
-app = FastAPI()
-
-# ---------------------------------------------------------------------------
-# Configuration
-# ---------------------------------------------------------------------------
-config = configparser.ConfigParser()
-config_path = os.path.join(os.path.dirname(__file__), "stashplexagent.config")
-config.read(config_path)
-
-# Stash connection (config file values can be overridden by env vars)
-stash_ip = config.get("stash", "ip", fallback="192.168.1.71")
-stash_port = config.get("stash", "port", fallback="9999")
-stash_host = os.getenv("STASH_HOST", f"http://{stash_ip}:{stash_port}")
-
-# Stash API key – optional, needed when Stash has authentication enabled
-stash_api_key = os.getenv(
-    "STASH_API_KEY",
-    config.get("stash", "api_key", fallback=""),
-)
-
-# Debug / log level
-debug_enabled = (
-    os.getenv("DEBUG", "false").lower() == "true"
-    or config.getboolean("stash", "debug", fallback=False)
-)
-logger.setLevel(logging.DEBUG if debug_enabled else logging.INFO)
-
-# Cache TTL in seconds (0 = disabled)
-CACHE_TTL = int(os.getenv("CACHE_TTL", config.get("stash", "cache_ttl", fallback="300")))
-
-# Base URL for this agent – used to build image proxy URLs that Plex can reach.
-_cfg_base_url = config.get("plexagentserver", "agent_base_url", fallback="")
-if not _cfg_base_url:
-    _agent_host = config.get("plexagentserver", "host", fallback="0.0.0.0")
-    _agent_port = config.get("plexagentserver", "port", fallback="7979")
-    if _agent_host == "0.0.0.0":
-        _agent_host = "127.0.0.1"
-    _cfg_base_url = f"http://{_agent_host}:{_agent_port}"
-agent_base_url = os.getenv("AGENT_BASE_URL", _cfg_base_url)
-
-# Poster mode – reformat 16:9 screenshots into 2:3 poster images with black bars.
-# Requires AGENT_BASE_URL to be set so Plex can reach the proxy endpoint.
-poster_mode = (
-    os.getenv("POSTER_MODE", "false").lower() == "true"
-    or config.getboolean("plexagentserver", "poster_mode", fallback=False)
-)
-
-# Plex server connection – optional, enables direct poster upload to PMS.
-# Bypasses images.plex.tv which cannot reach private LAN addresses.
-plex_url = os.getenv("PLEX_URL", config.get("plex", "url", fallback="")).rstrip("/")
-plex_token = os.getenv("PLEX_TOKEN", config.get("plex", "token", fallback=""))
-plex_upload_enabled = bool(plex_url and plex_token and poster_mode)
-if plex_upload_enabled:
-    logger.info("Plex poster upload enabled → %s", plex_url)
-
-# ---------------------------------------------------------------------------
-# Simple TTL cache
-# ---------------------------------------------------------------------------
-_cache: dict[str, tuple[float, dict]] = {}
-
-
-def _cache_get(key: str) -> dict | None:
-    """Return cached value if it exists and hasn't expired."""
-    if CACHE_TTL <= 0:
-        return None
-    entry = _cache.get(key)
-    if entry is None:
-        return None
-    ts, value = entry
-    if time.monotonic() - ts > CACHE_TTL:
-        _cache.pop(key, None)
-        return None
-    return value
-
-
-def _cache_set(key: str, value: dict) -> None:
-    if CACHE_TTL > 0:
-        _cache[key] = (time.monotonic(), value)
-
-
-# ---------------------------------------------------------------------------
-# Middleware
-# ---------------------------------------------------------------------------
-@app.middleware("http")
-async def log_requests(request: Request, call_next):
-    logger.debug("Request: %s %s", request.method, request.url)
-    response = await call_next(request)
-
-    if debug_enabled and not request.url.path.startswith("/stash/"):
-        # Capture and log the response body, then re-wrap it
-        # (skip image proxy paths to avoid logging binary data)
-        response_body = b""
-        async for chunk in response.body_iterator:
-            response_body += chunk if isinstance(chunk, bytes) else chunk.encode()
-        try:
-            parsed = json.loads(response_body)
-            logger.debug(
-                "Response to Plex (%s %s) [%d]:\n%s",
-                request.method,
-                request.url.path,
-                response.status_code,
-                json.dumps(parsed, indent=2),
-            )
-        except (json.JSONDecodeError, UnicodeDecodeError):
-            logger.debug("Response body (raw, %d bytes)", len(response_body))
-        return Response(
-            content=response_body,
-            status_code=response.status_code,
-            headers=dict(response.headers),
-            media_type=response.media_type,
-        )
-
-    return response
-
-
-# ---------------------------------------------------------------------------
-# Stash helpers
-# ---------------------------------------------------------------------------
-def _sanitize_graphql_string(value: str) -> str:
-    """Escape characters that could break a GraphQL string literal."""
-    value = value.replace("\\", "\\\\")
-    value = value.replace('"', '\\"')
-    value = value.replace("\n", "\\n")
-    value = value.replace("\r", "\\r")
-    return value
-
-
-def _build_stash_headers() -> dict[str, str]:
-    """Build HTTP headers for Stash requests, including API key if set."""
-    headers: dict[str, str] = {"Content-Type": "application/json"}
-    if stash_api_key:
-        headers["ApiKey"] = stash_api_key
-    return headers
-
-
-SCENE_QUERY_TEMPLATE = """query {{
-  findScenes(scene_filter: {{ {filter} }}) {{
-    scenes {{
-      id
-      code
-      title
-      date
-      urls
-      rating100
-      details
-      director
-      created_at
-      tags {{ id name }}
-      studio {{ id name image_path parent_studio {{ id name }} }}
-      performers {{ id name image_path }}
-      groups {{ group {{ id name front_image_path }} scene_index }}
-      scene_markers {{ id title seconds primary_tag {{ name }} }}
-      files {{ path basename duration width height video_codec audio_codec frame_rate bit_rate size }}
-    }}
-  }}
-}}"""
-
-
-def _self_url(request_or_none=None) -> str:
-    """Return the base URL that Plex should use to reach *this* agent.
-
-    During a request context we could inspect the Host header, but the
-    simplest reliable approach is to build it from our configured listen
-    address.  The agent_host module-level variable is set once at startup.
-    """
-    return agent_base_url
-
-
-def parse_stash_response(filter_clause: str) -> dict | None:
-    """Query Stash and convert the response into a Plex MediaContainer dict."""
-    cache_key = f"filter:{filter_clause}"
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        logger.debug("Cache hit for %s", cache_key)
-        return cached
-
-    graphql_query = SCENE_QUERY_TEMPLATE.format(filter=filter_clause)
-
-    if debug_enabled:
-        logger.debug("GraphQL Query: %s", graphql_query)
-        logger.debug("Stash Host: %s", stash_host)
-        encoded_query = urllib.parse.quote(graphql_query)
-        logger.debug("Clickable GraphQL URL (encoded): %s/graphql?query=%s", stash_host, encoded_query)
-
-    try:
-        response = requests.post(
-            f"{stash_host}/graphql",
-            json={"query": graphql_query},
-            headers=_build_stash_headers(),
-            timeout=10,
-        )
-        response.raise_for_status()
-        jsondata = response.json()
-
-        if debug_enabled:
-            logger.debug("Stash Response: %s", jsondata)
-
-    except requests.exceptions.RequestException as e:
-        logger.error("Failed to connect to Stash: %s", e)
-        if debug_enabled:
-            logger.debug("Attempted URL: %s/graphql", stash_host)
-        return None
-    except Exception as e:
-        logger.error("Unexpected error: %s", e)
-        return None
-
-    scenes = (
-        jsondata.get("data", {})
-        .get("findScenes", {})
-        .get("scenes")
-    )
-
-    if not scenes or len(scenes) == 0:
-        logger.debug("No scenes found for filter: %s", filter_clause)
-        return None
-
-    # Build Plex MediaContainer with all matching scenes
-    metadata_list = []
-    for scene in scenes:
-        moviedata: dict = {}
-
-        # Artwork – use poster proxy (2:3 with black bars) when poster_mode is on
-        if poster_mode:
-            moviedata["art"] = f"{agent_base_url}/stash/scene/{scene['id']}/poster"
-            moviedata["thumb"] = f"{agent_base_url}/stash/scene/{scene['id']}/poster"
-        else:
-            moviedata["art"] = f"{agent_base_url}/stash/scene/{scene['id']}/screenshot"
-            moviedata["thumb"] = f"{agent_base_url}/stash/scene/{scene['id']}/screenshot"
-
-        # Identifiers
-        moviedata["guid"] = f"plex://movie/stash-video-{scene['id']}"
-        moviedata["key"] = f"/library/metadata/stash-video-{scene['id']}"
-        moviedata["ratingKey"] = f"stash-video-{scene['id']}"
-        moviedata["type"] = "movie"
-
-        # Core metadata (null-safe)
-        moviedata["title"] = scene.get("title") or scene.get("code") or ""
-        moviedata["summary"] = scene.get("details") or ""
-        moviedata["originallyAvailableAt"] = scene.get("date")
-
-        # Tagline – use production code if available and different from title
-        code = scene.get("code") or ""
-        if code and code != moviedata["title"]:
-            moviedata["tagline"] = code
-
-        date_str = scene.get("date") or ""
-        if len(date_str) >= 4:
-            try:
-                moviedata["year"] = int(date_str[:4])
-            except ValueError:
-                pass
-
-        # addedAt – when scene was added to Stash (ISO -> epoch integer)
-        created_at = scene.get("created_at") or ""
-        if created_at:
-            try:
-                dt = datetime.fromisoformat(created_at)
-                moviedata["addedAt"] = int(dt.timestamp())
-            except (ValueError, TypeError):
-                pass
-
-        # Studio (include parent studio / network name when available)
-        studio = scene.get("studio")
-        if studio and isinstance(studio, dict):
-            studio_name = studio.get("name", "")
-            parent = studio.get("parent_studio")
-            if parent and isinstance(parent, dict):
-                parent_name = parent.get("name", "")
-                if parent_name and parent_name != studio_name:
-                    moviedata["studio"] = f"{studio_name} ({parent_name})"
-                else:
-                    moviedata["studio"] = studio_name
-            else:
-                moviedata["studio"] = studio_name
-
-        # Rating (Stash uses 0-100, Plex uses 0-10 float)
-        rating100 = scene.get("rating100")
-        if rating100 is not None:
-            try:
-                moviedata["rating"] = round(int(rating100) / 10.0, 1)
-            except (ValueError, TypeError):
-                pass
-
-        # Director
-        director = scene.get("director") or ""
-        if director:
-            moviedata["Director"] = [{"tag": director}]
-
-        # Tags -> Genres
-        for tag in scene.get("tags") or []:
-            tag_name = tag.get("name")
-            if tag_name:
-                moviedata.setdefault("Genre", []).append({"tag": tag_name})
-
-        # Performers -> Roles
-        for performer in scene.get("performers") or []:
-            perf_name = performer.get("name")
-            if perf_name:
-                role: dict = {"tag": perf_name}
-                perf_id = performer.get("id")
-                if perf_id:
-                    role["thumb"] = f"{stash_host}/performer/{perf_id}/image"
-                moviedata.setdefault("Role", []).append(role)
-
-        # Groups -> Collections
-        for group_entry in scene.get("groups") or []:
-            group = group_entry.get("group")
-            if group and group.get("name"):
-                moviedata.setdefault("Collection", []).append({"tag": group["name"]})
-
-        # Scene markers -> Chapters
-        markers = scene.get("scene_markers") or []
-        if markers:
-            chapters = []
-            for marker in sorted(markers, key=lambda m: m.get("seconds", 0)):
-                chapter_title = marker.get("title") or ""
-                primary_tag = marker.get("primary_tag")
-                if not chapter_title and primary_tag:
-                    chapter_title = primary_tag.get("name", "")
-                chapters.append({
-                    "tag": chapter_title,
-                    "index": len(chapters) + 1,
-                    "startTimeOffset": int(marker.get("seconds", 0) * 1000),
-                })
-            if chapters:
-                moviedata["Chapter"] = chapters
-
-        # Media info from files[]
-        files = scene.get("files") or []
-        if files:
-            f = files[0]
-            duration_s = f.get("duration")
-            media: dict = {}
-
-            if duration_s is not None:
-                try:
-                    duration_ms = int(float(duration_s) * 1000)
-                    media["duration"] = duration_ms
-                    moviedata["duration"] = duration_ms
-                except (ValueError, TypeError):
-                    pass
-
-            width = f.get("width")
-            height = f.get("height")
-            if width:
-                media["width"] = width
-            if height:
-                media["height"] = height
-
-            video_codec = f.get("video_codec") or ""
-            if video_codec:
-                media["videoCodec"] = video_codec
-
-            audio_codec = f.get("audio_codec") or ""
-            if audio_codec:
-                media["audioCodec"] = audio_codec
-
-            bit_rate = f.get("bit_rate")
-            if bit_rate:
-                media["bitrate"] = bit_rate
-
-            frame_rate = f.get("frame_rate")
-            if frame_rate:
-                # Plex expects frame rate as a string label
-                fr = float(frame_rate)
-                if abs(fr - 23.976) < 0.5:
-                    media["videoFrameRate"] = "24p"
-                elif abs(fr - 24.0) < 0.5:
-                    media["videoFrameRate"] = "24p"
-                elif abs(fr - 25.0) < 0.5:
-                    media["videoFrameRate"] = "PAL"
-                elif abs(fr - 29.97) < 0.5:
-                    media["videoFrameRate"] = "NTSC"
-                elif abs(fr - 30.0) < 0.5:
-                    media["videoFrameRate"] = "30p"
-                elif abs(fr - 50.0) < 0.5:
-                    media["videoFrameRate"] = "50p"
-                elif abs(fr - 59.94) < 0.5 or abs(fr - 60.0) < 0.5:
-                    media["videoFrameRate"] = "60p"
-                else:
-                    media["videoFrameRate"] = f"{int(fr)}p"
-
-            # Plex nests file info under Media.Part
-            part: dict = {}
-            file_path = f.get("path") or ""
-            if file_path:
-                part["file"] = file_path
-            file_size = f.get("size")
-            if file_size:
-                part["size"] = file_size
-            if part:
-                media["Part"] = [part]
-
-            # Video resolution label
-            if height:
-                if height >= 2160:
-                    media["videoResolution"] = "4k"
-                elif height >= 1080:
-                    media["videoResolution"] = "1080"
-                elif height >= 720:
-                    media["videoResolution"] = "720"
-                elif height >= 480:
-                    media["videoResolution"] = "480"
-                else:
-                    media["videoResolution"] = "sd"
-
-            if media:
-                moviedata["Media"] = [media]
-
-        metadata_list.append(moviedata)
-
-    movie = {
-        "MediaContainer": {
-            "offset": 0,
-            "totalSize": len(metadata_list),
-            "identifier": "tv.plex.agents.custom.stash",
-            "size": len(metadata_list),
-            "Metadata": metadata_list,
-        }
-    }
-
-    _cache_set(cache_key, movie)
-    return movie
-
-
-def query_stash_by_filename(filename: str) -> dict | None:
-    if not filename:
-        return None
-    safe_name = _sanitize_graphql_string(filename)
-    filter_clause = f'path: {{value: "\\"{safe_name}\\"", modifier: INCLUDES}}'
-    return parse_stash_response(filter_clause)
-
-
-def query_stash_by_ratingKey(ratingKey: str) -> dict | None:
-    if not ratingKey:
-        return None
-    match = re.search(r"-(\d+)$", ratingKey)
-    if not match:
-        return None
-    scene_id = match.group(1)
-    filter_clause = f"id: {{value: {scene_id}, modifier: EQUALS}}"
-    return parse_stash_response(filter_clause)
-
-
-# ---------------------------------------------------------------------------
-# Plex endpoints
-# ---------------------------------------------------------------------------
-@app.get("/")
-async def root(response: Response):
-    response.headers["X-Plex-Client-Identifier"] = "stash.plex.provider.metadata"
-    return {
-        "MediaProvider": {
-            "identifier": "tv.plex.agents.custom.stash",
-            "title": "Stash Plex Metadata Provider",
-            "version": "1.1.0",
-            "Types": [
-                {
-                    "type": 1,
-                    "Scheme": [{"scheme": "tv.plex.agents.custom.stash"}],
-                },
-            ],
-            "Feature": [
-                {"type": "metadata", "key": "/library/metadata"},
-                {"type": "match", "key": "/library/metadata/matches"},
-            ],
-        }
-    }
-
-
-@app.post("/library/metadata/matches")
-async def library_metadata_matches(request: Request):
-    body = await request.json()
-    if debug_enabled:
-        logger.debug("Match request body:\n%s", json.dumps(body, indent=2))
-
-    # Plex may request certain elements be excluded from the response
-    exclude_elements = {
-        e.strip() for e in (body.get("excludeElements") or "").split(",") if e.strip()
-    }
-
-    filename = body.get("filename")
-    if filename:
-        result = query_stash_by_filename(filename)
-        if result and exclude_elements:
-            for item in result.get("MediaContainer", {}).get("Metadata", []):
-                for element in exclude_elements:
-                    item.pop(element, None)
-        if result:
-            return result
-    return {"MediaContainer": {"offset": 0, "totalSize": 0, "identifier": "tv.plex.agents.custom.stash", "size": 0, "Metadata": []}}
-
-
-@app.get("/library/metadata/{ratingKey}")
-async def get_metadata(ratingKey: str, background_tasks: BackgroundTasks):
-    logger.info("Fetching metadata for ratingKey: %s", ratingKey)
-    result = query_stash_by_ratingKey(ratingKey)
-    if result and plex_upload_enabled:
-        metadata_list = result.get("MediaContainer", {}).get("Metadata", [])
-        if metadata_list:
-            title = metadata_list[0].get("title", "")
-            match = re.search(r"-(\d+)$", ratingKey)
-            if match and title:
-                background_tasks.add_task(
-                    _upload_poster_to_plex, match.group(1), title
-                )
-    if result:
-        return result
-    return {"MediaContainer": {"offset": 0, "totalSize": 0, "identifier": "tv.plex.agents.custom.stash", "size": 0, "Metadata": []}}
-
-
-@app.get("/library/metadata/{ratingKey}/extras")
-async def get_metadata_extras(ratingKey: str):
-    return {"MediaContainer": {"offset": 0, "totalSize": 0, "identifier": "tv.plex.agents.custom.stash", "size": 0, "Metadata": []}}
-
-
-# ---------------------------------------------------------------------------
-# Image proxy – Plex fetches images through us so it doesn't need LAN access
-# to Stash directly (images.plex.tv cannot reach private addresses).
-# ---------------------------------------------------------------------------
-@app.get("/stash/scene/{scene_id}/screenshot")
-async def proxy_scene_screenshot(scene_id: str):
-    """Proxy a scene screenshot from Stash."""
-    return _proxy_stash_image(f"{stash_host}/scene/{scene_id}/screenshot")
-
-
-@app.get("/stash/performer/{performer_id}/image")
-async def proxy_performer_image(performer_id: str):
-    """Proxy a performer image from Stash."""
-    return _proxy_stash_image(f"{stash_host}/performer/{performer_id}/image")
-
-
-@app.get("/stash/group/{group_id}/front")
-async def proxy_group_front_image(group_id: str):
-    """Proxy a group front image from Stash."""
-    return _proxy_stash_image(f"{stash_host}/group/{group_id}/front_image")
-
-
-@app.get("/stash/scene/{scene_id}/poster")
-async def proxy_scene_poster(scene_id: str):
-    """Fetch screenshot from Stash and reformat to 2:3 poster with black bars."""
-    poster_bytes = _generate_poster_bytes(scene_id)
-    if poster_bytes is None:
-        return Response(status_code=502, content=b"Image processing error")
-    return Response(
-        content=poster_bytes,
-        media_type="image/jpeg",
-        headers={
-            "Cache-Control": "public, max-age=86400",
-            "Content-Length": str(len(poster_bytes)),
-        },
-    )
-
-
-def _proxy_stash_image(stash_url: str) -> Response:
-    """Fetch an image from Stash and return it as a Response."""
-    headers = _build_stash_headers()
-    # Remove Content-Type for image fetch – let Stash decide
-    headers.pop("Content-Type", None)
-    try:
-        resp = requests.get(stash_url, headers=headers, timeout=10)
-        resp.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.error("Image proxy failed for %s: %s", stash_url, e)
-        return Response(status_code=502, content=b"Bad Gateway")
-
-    content_type = resp.headers.get("Content-Type", "image/jpeg")
-    return Response(
-        content=resp.content,
-        media_type=content_type,
-        headers={"Cache-Control": "public, max-age=86400"},
-    )
-
-
-POSTER_WIDTH = 600   # px – produces a 600x900 poster (2:3 aspect ratio)
-POSTER_HEIGHT = 900
-
-
-def _generate_poster_bytes(scene_id: str) -> bytes | None:
-    """Fetch scene screenshot from Stash and return 2:3 poster JPEG bytes."""
-    stash_url = f"{stash_host}/scene/{scene_id}/screenshot"
-    headers = _build_stash_headers()
-    headers.pop("Content-Type", None)
-    try:
-        resp = requests.get(stash_url, headers=headers, timeout=10)
-        resp.raise_for_status()
-    except requests.exceptions.RequestException as e:
-        logger.error("Poster fetch failed for scene %s: %s", scene_id, e)
-        return None
-
-    try:
-        src = Image.open(io.BytesIO(resp.content))
-        src_w, src_h = src.size
-        scale = POSTER_WIDTH / src_w
-        scaled_h = int(src_h * scale)
-        src = src.resize((POSTER_WIDTH, scaled_h), Image.LANCZOS)
-        poster = Image.new("RGB", (POSTER_WIDTH, POSTER_HEIGHT), (0, 0, 0))
-        y_offset = (POSTER_HEIGHT - scaled_h) // 2
-        poster.paste(src, (0, y_offset))
-        buf = io.BytesIO()
-        poster.save(buf, format="JPEG", quality=85)
-        return buf.getvalue()
-    except Exception as e:
-        logger.error("Poster generation failed for scene %s: %s", scene_id, e)
-        return None
-
-
-# ---------------------------------------------------------------------------
-# Plex poster upload – pushes posters directly to PMS so they're stored
-# locally, bypassing images.plex.tv which can't reach private LAN addresses.
-# ---------------------------------------------------------------------------
-_uploaded_posters: set[str] = set()
-
-
-def _get_pms_movie_section_keys() -> list[str]:
-    """Get keys of all movie-type library sections from PMS."""
-    try:
-        resp = requests.get(
-            f"{plex_url}/library/sections",
-            params={"X-Plex-Token": plex_token},
-            headers={"Accept": "application/json"},
-            timeout=10,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        keys = []
-        for directory in data.get("MediaContainer", {}).get("Directory", []):
-            if directory.get("type") == "movie":
-                keys.append(directory["key"])
-        logger.debug("PMS movie library sections: %s", keys)
-        return keys
-    except Exception as e:
-        logger.warning("Failed to get PMS library sections: %s", e)
-        return []
-
-
-def _search_pms_sections(section_keys: list[str], title: str, guid: str) -> str | None:
-    """Search PMS library sections once for an item matching the given GUID."""
-    for key in section_keys:
-        try:
-            resp = requests.get(
-                f"{plex_url}/library/sections/{key}/all",
-                params={
-                    "type": 1,
-                    "title": title,
-                    "X-Plex-Token": plex_token,
-                },
-                headers={"Accept": "application/json"},
-                timeout=10,
-            )
-            resp.raise_for_status()
-            data = resp.json()
-            items = data.get("MediaContainer", {}).get("Metadata", [])
-            if debug_enabled:
-                logger.debug(
-                    "PMS section %s search for '%s': %d results",
-                    key, title, len(items),
-                )
-            for item in items:
-                if item.get("guid") == guid:
-                    return item.get("ratingKey")
-                for g in item.get("Guid", []):
-                    if g.get("id") == guid:
-                        return item.get("ratingKey")
-        except Exception as e:
-            logger.warning("PMS section %s search failed: %s", key, e)
-    return None
-
-
-def _upload_poster_to_plex(scene_id: str, title: str):
-    """Background task: find the item in PMS and upload the poster directly."""
-    if scene_id in _uploaded_posters:
-        return
-
-    guid = f"plex://movie/stash-video-{scene_id}"
-    section_keys = _get_pms_movie_section_keys()
-    if not section_keys:
-        logger.error("No movie library sections found in PMS")
-        return
-
-    # Try immediately — item already exists for refreshes
-    pms_key = _search_pms_sections(section_keys, title, guid)
-    if pms_key:
-        logger.info("PMS item found immediately for scene %s (refresh)", scene_id)
-    else:
-        # New item — wait for PMS to finish ingesting, then retry
-        logger.debug("PMS item not found yet for scene %s, waiting for PMS to ingest...", scene_id)
-        time.sleep(5)
-        for attempt in range(8):
-            pms_key = _search_pms_sections(section_keys, title, guid)
-            if pms_key:
-                break
-            if attempt < 7:
-                logger.debug("PMS item not found (attempt %d/8), retrying in 5s...", attempt + 1)
-                time.sleep(5)
-
-    if not pms_key:
-        logger.error("PMS item not found for scene %s (GUID: %s)", scene_id, guid)
-        return
-
-    logger.debug("Found PMS ratingKey %s for scene %s", pms_key, scene_id)
-
-    poster_bytes = _generate_poster_bytes(scene_id)
-    if poster_bytes is None:
-        return
-
-    try:
-        resp = requests.post(
-            f"{plex_url}/library/metadata/{pms_key}/posters",
-            params={"X-Plex-Token": plex_token},
-            data=poster_bytes,
-            headers={"Content-Type": "application/octet-stream"},
-            timeout=30,
-        )
-        resp.raise_for_status()
-        logger.info("Uploaded poster to PMS for scene %s (PMS key: %s)", scene_id, pms_key)
-        _uploaded_posters.add(scene_id)
-    except Exception as e:
-        logger.error("Failed to upload poster to PMS for scene %s: %s", scene_id, e)
-
-
-@app.get("/health")
-async def health():
-    return {"status": "ok"}
-
-
-# For direct execution during development only
-if __name__ == "__main__":
-    import uvicorn
-    server_host = config.get("plexagentserver", "host", fallback="0.0.0.0")
-    server_port = int(config.get("plexagentserver", "port", fallback="7979"))
-    uvicorn.run(app, host=server_host, port=server_port, reload=True)
+import asyncio
+import atexit
+import bisect
+import collections
+import concurrent.futures
+import io
+import os
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import operator
+import httpx
+import orjson
+import requests
+import urllib.parse
+from datetime import datetime, timezone
+from urllib3.util.retry import Retry
+from fastapi import BackgroundTasks, FastAPI, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from PIL import Image
+
+from settings import DEBUG, PLEX_CFG, SERVER_CFG, STASH_CFG, TRUTHY
+
+# ---------------------------------------------------------------------------
+# Logging
+# ---------------------------------------------------------------------------
+# Log records are enqueued on the request path and written to stdout by a
+# background listener thread, so the event loop never blocks on the
+# stream-write syscall.
+logger = logging.getLogger("stashplexagent")
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_stream_handler = logging.StreamHandler()
+_stream_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+
+# Threads don't survive fork: with gunicorn's preload_app the listener
+# above starts in the master only, and forked workers would enqueue
+# records nobody drains — silently losing all worker output. Restart the
+# listener thread in each child (start() spins up a fresh thread on the
+# inherited queue/handler).
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_log_listener.start)
+
+# orjson (Rust) encodes/decodes JSON 2-5x faster than stdlib json and
+# returns bytes directly, skipping Starlette's str->bytes pass.
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# ---------------------------------------------------------------------------
+# Configuration
+# ---------------------------------------------------------------------------
+# Stash connection (config file values can be overridden by env vars)
+stash_ip = STASH_CFG.get("ip", "192.168.1.71")
+stash_port = STASH_CFG.get("port", "9999")
+stash_host = os.getenv("STASH_HOST", f"http://{stash_ip}:{stash_port}")
+
+# Stash API key – optional, needed when Stash has authentication enabled
+stash_api_key = os.getenv("STASH_API_KEY", STASH_CFG.get("api_key", ""))
+
+# Debug / log level (resolved once in settings, shared with main.py)
+debug_enabled = DEBUG
+logger.setLevel(logging.DEBUG if debug_enabled else logging.INFO)
+
+# Cache TTL in seconds (0 = disabled) and maximum entry count
+CACHE_TTL = int(os.getenv("CACHE_TTL", STASH_CFG.get("cache_ttl", "300")))
+CACHE_MAXSIZE = int(os.getenv("CACHE_MAXSIZE", STASH_CFG.get("cache_maxsize", "2048")))
+
+# Base URL for this agent – used to build image proxy URLs that Plex can reach.
+_cfg_base_url = SERVER_CFG.get("agent_base_url", "")
+if not _cfg_base_url:
+    _agent_host = SERVER_CFG.get("host", "0.0.0.0")
+    _agent_port = SERVER_CFG.get("port", "7979")
+    if _agent_host == "0.0.0.0":
+        _agent_host = "127.0.0.1"
+    _cfg_base_url = f"http://{_agent_host}:{_agent_port}"
+agent_base_url = os.getenv("AGENT_BASE_URL", _cfg_base_url)
+
+# Poster mode – reformat 16:9 screenshots into 2:3 poster images with black bars.
+# Requires AGENT_BASE_URL to be set so Plex can reach the proxy endpoint.
+poster_mode = (
+    os.environ.get("POSTER_MODE", "").lower() in TRUTHY
+    or SERVER_CFG.get("poster_mode", "").lower() in TRUTHY
+)
+
+# Plex server connection – optional, enables direct poster upload to PMS.
+# Bypasses images.plex.tv which cannot reach private LAN addresses.
+plex_url = os.getenv("PLEX_URL", PLEX_CFG.get("url", "")).rstrip("/")
+plex_token = os.getenv("PLEX_TOKEN", PLEX_CFG.get("token", ""))
+plex_upload_enabled = bool(plex_url and plex_token and poster_mode)
+if plex_upload_enabled:
+    logger.info("Plex poster upload enabled → %s", plex_url)
+
+# ---------------------------------------------------------------------------
+# Simple TTL cache — bounded and thread-safe. Entries are kept in LRU
+# order (hits move to the back) and the oldest is evicted past
+# CACHE_MAXSIZE, so a big library scan can't grow the cache forever.
+# Kept hand-rolled rather than cachetools.TTLCache because the PMS
+# section list needs a per-entry ttl override, which TTLCache lacks.
+# ---------------------------------------------------------------------------
+_cache: "collections.OrderedDict[str, tuple[float, dict]]" = collections.OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _cache_get(key: str) -> dict | None:
+    """Return cached value if it exists and hasn't expired."""
+    if CACHE_TTL <= 0:
+        return None
+    with _cache_lock:
+        entry = _cache.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() > expires_at:
+            del _cache[key]
+            return None
+        _cache.move_to_end(key)
+    return value
+
+
+def _cache_set(key: str, value: dict, ttl: int | None = None) -> None:
+    """Cache a value; ttl overrides CACHE_TTL for slow-changing data."""
+    if CACHE_TTL <= 0:
+        return
+    expires_at = time.monotonic() + (CACHE_TTL if ttl is None else ttl)
+    with _cache_lock:
+        _cache[key] = (expires_at, value)
+        _cache.move_to_end(key)
+        if len(_cache) > CACHE_MAXSIZE:
+            _cache.popitem(last=False)
+
+
+# ---------------------------------------------------------------------------
+# Middleware
+# ---------------------------------------------------------------------------
+class LogRequestsMiddleware:
+    """Debug-only response-body logger, written as pure ASGI.
+
+    The ``@app.middleware("http")`` decorator goes through Starlette's
+    BaseHTTPMiddleware, which builds Request/Response objects and an extra
+    task per call even when the middleware does nothing. Wrapping ``send``
+    directly avoids all of that; image proxy paths (``/stash/``) and
+    non-HTTP scopes pass straight through untouched.
+
+    The request line itself (method/path/status) is uvicorn's access
+    log's job — enabled alongside debug in main.py — so this only adds
+    what uvicorn can't: the JSON body we returned to Plex.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        # Checked per request (not baked in at startup) so dropping the
+        # logger below DEBUG at runtime stops the buffering work too.
+        if (
+            scope["type"] != "http"
+            or scope["path"].startswith("/stash/")
+            or not logger.isEnabledFor(logging.DEBUG)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        chunks: list[bytes] = []
+        status = 0
+
+        async def send_wrapper(message):
+            nonlocal status
+            # Forward each message before doing any bookkeeping: the client
+            # shouldn't wait on JSON pretty-printing for its final chunk,
+            # and response.background keeps running untouched since we never
+            # rebuild the Response.
+            await send(message)
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                # Collect chunks and join once at the end: O(n) total and a
+                # single final allocation, vs repeated grow-and-copy.
+                chunks.append(message.get("body", b""))
+                if not message.get("more_body", False):
+                    self._log_body(scope, status, b"".join(chunks))
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _log_body(scope, status: int, body: bytes) -> None:
+        try:
+            parsed = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            logger.debug("Response body (raw, %d bytes)", len(body))
+            return
+        logger.debug(
+            "Response to Plex (%s %s) [%d]:\n%s",
+            scope["method"],
+            scope["path"],
+            status,
+            orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode(),
+        )
+
+
+# Only registered when debugging; the normal serving path keeps a bare
+# middleware stack.
+if debug_enabled:
+    app.add_middleware(LogRequestsMiddleware)
+
+
+# ---------------------------------------------------------------------------
+# HTTP connection pools
+# ---------------------------------------------------------------------------
+# A bare requests.get/post builds a throwaway session per call, paying a TCP
+# (and possibly TLS) handshake to Stash or PMS every time. Module-level
+# sessions keep the sockets warm via HTTPAdapter keep-alive across all
+# queries, image fetches and poster uploads.
+def _make_session() -> requests.Session:
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=16,
+        pool_maxsize=32,
+        # Transparently retry transient connect/read failures; 0.1s backoff
+        # keeps the worst case well under the 10s request timeouts.
+        max_retries=Retry(total=2, backoff_factor=0.1),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_stash_session = _make_session()
+_plex_session = _make_session()
+
+# Async keep-alive client to Stash, shared by the GraphQL path and the
+# streaming image proxies so endpoint handlers never block the event
+# loop on a Stash round-trip. Pool sizing mirrors the sync sessions.
+_stash_async_client = httpx.AsyncClient(
+    timeout=10,
+    limits=httpx.Limits(max_keepalive_connections=16, max_connections=32),
+)
+
+# Bake the PMS token and Accept header into the session once; per-call
+# sites then only pass what actually varies (the title filter).
+_plex_session.headers["Accept"] = "application/json"
+if plex_token:
+    _plex_session.params = {"X-Plex-Token": plex_token}
+
+
+# ---------------------------------------------------------------------------
+# Stash helpers
+# ---------------------------------------------------------------------------
+def _build_stash_headers() -> dict[str, str]:
+    """Build HTTP headers for Stash requests, including API key if set."""
+    headers: dict[str, str] = {"Content-Type": "application/json"}
+    if stash_api_key:
+        headers["ApiKey"] = stash_api_key
+    return headers
+
+
+# The API key never changes at runtime, so build the header dicts once.
+# Image fetches omit Content-Type – let Stash decide the media type.
+_stash_headers = _build_stash_headers()
+_stash_image_headers = {
+    k: v for k, v in _stash_headers.items() if k != "Content-Type"
+}
+
+# GraphQL endpoint, resolved once instead of an f-string per request
+_GRAPHQL_URL = f"{stash_host}/graphql"
+
+
+# Scene field selection, shared by the single-filter query and the batched
+# (aliased) query built by the coalescer below. Only the fields that
+# _scenes_to_container actually reads — everything requested here is
+# payload Stash must serialize and we must parse, per scene, per lookup.
+_SCENE_FIELDS = """{
+  id
+  code
+  title
+  date
+  rating100
+  details
+  director
+  created_at
+  tags { name }
+  studio { name parent_studio { name } }
+  performers { id name }
+  groups { group { name } }
+  scene_markers { title seconds primary_tag { name } }
+  files { path duration width height video_codec audio_codec frame_rate bit_rate size }
+}"""
+
+
+# Known frame rates → Plex labels, sorted so the scene loop can bisect
+# instead of walking an if/elif ladder per file.
+_FRAME_RATES = (
+    (23.976, "24p"),
+    (24.0, "24p"),
+    (25.0, "PAL"),
+    (29.97, "NTSC"),
+    (30.0, "30p"),
+    (50.0, "50p"),
+    (59.94, "60p"),
+    (60.0, "60p"),
+)
+_FRAME_RATE_KEYS = [rate for rate, _ in _FRAME_RATES]
+
+# Height thresholds → Plex resolution labels, highest first
+_RESOLUTIONS = ((2160, "4k"), (1080, "1080"), (720, "720"), (480, "480"))
+
+# Sort key for scene markers, built once instead of a fresh lambda per scene
+_MARKER_SECONDS = operator.methodcaller("get", "seconds", 0)
+
+# Aliased sub-query templates for the two lookup shapes; values travel
+# as GraphQL variables so the document text stays fixed (parse-cacheable
+# by Stash) and needs no string escaping. %d slots take the batch index.
+_SUBQUERY_TMPLS = {
+    "id": (
+        "q%d: findScenes(scene_filter: { id: {value: $v%d, modifier: EQUALS} })"
+        " { scenes " + _SCENE_FIELDS + " }"
+    ),
+    "path": (
+        "q%d: findScenes(scene_filter: { path: {value: $v%d, modifier: INCLUDES} })"
+        " { scenes " + _SCENE_FIELDS + " }"
+    ),
+}
+_VAR_TYPES = {"id": "Int!", "path": "String!"}
+
+
+def _frame_rate_label(fr: float) -> str:
+    """Map a frame rate to Plex's label (nearest known rate within 0.5)."""
+    idx = bisect.bisect_left(_FRAME_RATE_KEYS, fr)
+    best = -1
+    for i in (idx - 1, idx):
+        if 0 <= i < len(_FRAME_RATE_KEYS) and (
+            best < 0 or abs(_FRAME_RATE_KEYS[i] - fr) < abs(_FRAME_RATE_KEYS[best] - fr)
+        ):
+            best = i
+    if best >= 0 and abs(_FRAME_RATE_KEYS[best] - fr) < 0.5:
+        return _FRAME_RATES[best][1]
+    return f"{int(fr)}p"
+
+
+def _self_url(request_or_none=None) -> str:
+    """Return the base URL that Plex should use to reach *this* agent.
+
+    During a request context we could inspect the Host header, but the
+    simplest reliable approach is to build it from our configured listen
+    address.  The agent_host module-level variable is set once at startup.
+    """
+    return agent_base_url
+
+
+class _LazyQuote:
+    """URL-encode a string only if the log record is actually formatted.
+
+    Passed as a %s argument so the multi-KB quoted query is produced at
+    emit time by the listener thread, not eagerly on the request path.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: str):
+        self.value = value
+
+    def __str__(self) -> str:
+        return urllib.parse.quote(self.value)
+
+
+async def _post_graphql(graphql_query: str, variables: dict | None = None) -> dict | None:
+    """POST a GraphQL document to Stash and return the parsed JSON body.
+
+    Runs on the shared async client: the event loop keeps serving other
+    requests during the Stash round-trip instead of stalling on a
+    blocking socket, so concurrent Plex lookups proceed in parallel.
+    """
+    # Bind the hot module globals once: LOAD_FAST beats repeated
+    # LOAD_GLOBAL dict lookups on a function that runs per lookup batch.
+    log = logger
+    graphql_url = _GRAPHQL_URL
+
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("GraphQL Query: %s", graphql_query)
+        log.debug("Stash Host: %s", stash_host)
+        log.debug(
+            "Clickable GraphQL URL (encoded): %s?query=%s",
+            graphql_url, _LazyQuote(graphql_query),
+        )
+
+    body: dict = {"query": graphql_query}
+    if variables:
+        body["variables"] = variables
+
+    try:
+        # content= with pre-encoded orjson bytes; json= would run the body
+        # through stdlib json. _stash_headers already carries Content-Type.
+        response = await _stash_async_client.post(
+            graphql_url,
+            content=orjson.dumps(body),
+            headers=_stash_headers,
+        )
+        response.raise_for_status()
+        jsondata = orjson.loads(response.content)
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Stash Response: %s", jsondata)
+
+        return jsondata
+    except httpx.HTTPError as e:
+        log.error("Failed to connect to Stash: %s", e)
+        if debug_enabled:
+            log.debug("Attempted URL: %s", graphql_url)
+        return None
+    except Exception as e:
+        logger.error("Unexpected error: %s", e)
+        return None
+
+
+async def parse_stash_response(kind: str, value) -> dict | None:
+    """Query Stash and convert the response into a Plex MediaContainer dict.
+
+    ``kind`` is "id" or "path"; the value travels as a GraphQL variable.
+    Goes through the coalescer, so concurrent lookups during a scan burst
+    — filename matches and ratingKey fetches alike — collapse into one
+    aliased GraphQL round-trip.
+    """
+    cache_key = f"{kind}:{value}"
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        logger.debug("Cache hit for %s", cache_key)
+        return cached
+
+    scenes = await _scene_loader.load(kind, value)
+    if not scenes:
+        logger.debug("No scenes found for %s", cache_key)
+        return None
+
+    movie = _scenes_to_container(scenes)
+    _cache_set(cache_key, movie)
+    return movie
+
+
+# Which proxy endpoint artwork URLs point at; poster_mode is fixed at startup
+_ART_VARIANT = "poster" if poster_mode else "screenshot"
+
+
+# Constant part of every MediaContainer we emit, spread into each
+# response instead of re-keying the scaffold per call. The shared empty
+# container answers misses and /extras; nothing mutates it.
+_MC_BASE = {"offset": 0, "identifier": "tv.plex.agents.custom.stash"}
+_EMPTY_CONTAINER = {
+    "MediaContainer": {**_MC_BASE, "totalSize": 0, "size": 0, "Metadata": []}
+}
+
+
+def _scenes_to_container(scenes: list[dict]) -> dict:
+    """Convert a list of Stash scenes into a Plex MediaContainer dict."""
+    metadata_list = []
+    for scene in scenes:
+        # Pull every field out of the scene dict once up front; the rest of
+        # the iteration works on locals instead of re-running scene.get()
+        # (and its hash lookup) for each use.
+        sid = scene["id"]
+        code = scene.get("code") or ""
+        date = scene.get("date")
+        created_at = scene.get("created_at")
+        rating100 = scene.get("rating100")
+        director = scene.get("director")
+        studio = scene.get("studio")
+        tags = scene.get("tags") or ()
+        performers = scene.get("performers") or ()
+        groups = scene.get("groups") or ()
+        markers = scene.get("scene_markers") or ()
+        files = scene.get("files") or ()
+
+        stash_key = f"stash-video-{sid}"
+        # Artwork – poster proxy (2:3 with black bars) when poster_mode is on.
+        # art and thumb share one string; guid/key/ratingKey share stash_key.
+        art_url = f"{agent_base_url}/stash/scene/{sid}/{_ART_VARIANT}"
+        title = scene.get("title") or code or ""
+
+        moviedata: dict = {
+            "art": art_url,
+            "thumb": art_url,
+            "guid": f"plex://movie/{stash_key}",
+            "key": f"/library/metadata/{stash_key}",
+            "ratingKey": stash_key,
+            "type": "movie",
+            "title": title,
+            "summary": scene.get("details") or "",
+            "originallyAvailableAt": date,
+        }
+
+        # Tagline – use production code if available and different from title
+        if code and code != title:
+            moviedata["tagline"] = code
+
+        # Leading four digits of the (already-local) date; malformed dates
+        # just fail the isdigit check instead of raising out of int()
+        if date:
+            year_str = date[:4]
+            if len(year_str) == 4 and year_str.isdigit():
+                moviedata["year"] = int(year_str)
+
+        # addedAt – when scene was added to Stash (ISO -> epoch integer)
+        if created_at:
+            try:
+                dt = datetime.fromisoformat(created_at)
+                moviedata["addedAt"] = int(dt.timestamp())
+            except (ValueError, TypeError):
+                pass
+
+        # Studio (include parent studio / network name when available)
+        if studio and isinstance(studio, dict):
+            studio_name = studio.get("name", "")
+            parent = studio.get("parent_studio")
+            if parent and isinstance(parent, dict):
+                parent_name = parent.get("name", "")
+                if parent_name and parent_name != studio_name:
+                    moviedata["studio"] = f"{studio_name} ({parent_name})"
+                else:
+                    moviedata["studio"] = studio_name
+            else:
+                moviedata["studio"] = studio_name
+
+        # Rating (Stash uses 0-100, Plex uses 0-10 float)
+        if rating100 is not None:
+            try:
+                moviedata["rating"] = round(int(rating100) / 10.0, 1)
+            except (ValueError, TypeError):
+                pass
+
+        # Director
+        if director:
+            moviedata["Director"] = [{"tag": director}]
+
+        # Tags -> Genres: single-pass comprehensions assigned once, rather
+        # than a per-element append loop (same for Role/Collection)
+        genres = [{"tag": name} for tag in tags if (name := tag.get("name"))]
+        if genres:
+            moviedata["Genre"] = genres
+
+        # Performers -> Roles
+        roles = [
+            {"tag": name, "thumb": f"{stash_host}/performer/{performer['id']}/image"}
+            if performer.get("id")
+            else {"tag": name}
+            for performer in performers
+            if (name := performer.get("name"))
+        ]
+        if roles:
+            moviedata["Role"] = roles
+
+        # Groups -> Collections
+        collections_ = [
+            {"tag": group["name"]}
+            for group_entry in groups
+            if (group := group_entry.get("group")) and group.get("name")
+        ]
+        if collections_:
+            moviedata["Collection"] = collections_
+
+        # Scene markers -> Chapters
+        if markers:
+            chapters = []
+            for marker in sorted(markers, key=_MARKER_SECONDS):
+                chapter_title = marker.get("title") or ""
+                primary_tag = marker.get("primary_tag")
+                if not chapter_title and primary_tag:
+                    chapter_title = primary_tag.get("name", "")
+                chapters.append({
+                    "tag": chapter_title,
+                    "index": len(chapters) + 1,
+                    "startTimeOffset": int(marker.get("seconds", 0) * 1000),
+                })
+            if chapters:
+                moviedata["Chapter"] = chapters
+
+        # Media info from files[]
+        if files:
+            f = files[0]
+            duration_s = f.get("duration")
+            media: dict = {}
+
+            if duration_s is not None:
+                try:
+                    duration_ms = int(float(duration_s) * 1000)
+                    media["duration"] = duration_ms
+                    moviedata["duration"] = duration_ms
+                except (ValueError, TypeError):
+                    pass
+
+            width = f.get("width")
+            height = f.get("height")
+            if width:
+                media["width"] = width
+            if height:
+                media["height"] = height
+
+            video_codec = f.get("video_codec") or ""
+            if video_codec:
+                media["videoCodec"] = video_codec
+
+            audio_codec = f.get("audio_codec") or ""
+            if audio_codec:
+                media["audioCodec"] = audio_codec
+
+            bit_rate = f.get("bit_rate")
+            if bit_rate:
+                media["bitrate"] = bit_rate
+
+            frame_rate = f.get("frame_rate")
+            if frame_rate:
+                # Plex expects frame rate as a string label
+                media["videoFrameRate"] = _frame_rate_label(float(frame_rate))
+
+            # Plex nests file info under Media.Part
+            part: dict = {}
+            file_path = f.get("path") or ""
+            if file_path:
+                part["file"] = file_path
+            file_size = f.get("size")
+            if file_size:
+                part["size"] = file_size
+            if part:
+                media["Part"] = [part]
+
+            # Video resolution label
+            if height:
+                media["videoResolution"] = next(
+                    (label for threshold, label in _RESOLUTIONS if height >= threshold),
+                    "sd",
+                )
+
+            if media:
+                moviedata["Media"] = [media]
+
+        metadata_list.append(moviedata)
+
+    size = len(metadata_list)
+    return {
+        "MediaContainer": {
+            **_MC_BASE,
+            "totalSize": size,
+            "size": size,
+            "Metadata": metadata_list,
+        }
+    }
+
+
+class _StashQueryCoalescer:
+    """Batch concurrent scene lookups into one aliased GraphQL query.
+
+    During a library scan Plex fires many match requests within
+    milliseconds, each of which used to cost its own HTTP round-trip and
+    GraphQL parse at Stash. Lookups awaited through :meth:`load` are
+    buffered for a short window, drained into a single document of aliased
+    ``findScenes`` sub-queries, POSTed once, and fanned back out to the
+    awaiting callers by alias.
+    """
+
+    def __init__(self, window: float = 0.02):
+        self.window = window
+        self._pending: list[tuple[str, object, "asyncio.Future"]] = []
+        self._flusher: asyncio.Task | None = None
+
+    async def load(self, kind: str, value) -> list | None:
+        """Return the scenes for one id/path lookup, batched with concurrent calls."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((kind, value, future))
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_soon())
+        return await future
+
+    async def _flush_soon(self):
+        await asyncio.sleep(self.window)
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        var_defs = ", ".join(
+            f"$v{i}: {_VAR_TYPES[kind]}" for i, (kind, _, _) in enumerate(batch)
+        )
+        parts = [_SUBQUERY_TMPLS[kind] % (i, i) for i, (kind, _, _) in enumerate(batch)]
+        document = f"query ({var_defs}) {{ " + " ".join(parts) + " }"
+        variables = {f"v{i}": value for i, (_, value, _) in enumerate(batch)}
+        logger.debug("Coalesced %d Stash lookups into one query", len(batch))
+
+        jsondata = await _post_graphql(document, variables)
+        # One structured access under try/except instead of chained .get()
+        # defaults — the happy path costs one lookup per level, and error
+        # payloads (no "data", null aliases) all land in the except arm.
+        try:
+            data = jsondata["data"]
+        except (KeyError, TypeError):
+            data = {}
+        for i, (_, _, future) in enumerate(batch):
+            if future.done():
+                continue
+            try:
+                scenes = data[f"q{i}"]["scenes"] or None
+            except (KeyError, TypeError):
+                scenes = None
+            future.set_result(scenes)
+
+        # Lookups that arrived during the round-trip above were appended
+        # to _pending while this task was still not done, so load() did
+        # not schedule a flusher for them. Re-arm here or they'd sit
+        # unresolved until some future load() happened to come in.
+        if self._pending:
+            self._flusher = asyncio.create_task(self._flush_soon())
+
+
+_scene_loader = _StashQueryCoalescer()
+
+
+async def query_stash_by_filename(filename: str) -> dict | None:
+    if not filename:
+        return None
+    # Surrounding quotes select Stash's exact-phrase path search; the
+    # filename itself needs no escaping since it rides in a variable.
+    return await parse_stash_response("path", f'"{filename}"')
+
+
+def _rating_key_scene_id(ratingKey: str) -> str | None:
+    """Extract the trailing scene id from a "stash-video-<id>" ratingKey.
+
+    Plain string ops instead of a regex: Plex probes with plenty of keys
+    that aren't ours, and the common miss should cost two C-level string
+    checks, not a trip into the regex engine.
+    """
+    prefix, _, scene_id = ratingKey.rpartition("-")
+    # isdecimal, not isdigit: the latter accepts characters like "²"
+    # that int() rejects; isdecimal matches exactly what int() takes.
+    if prefix and scene_id.isdecimal():
+        return scene_id
+    return None
+
+
+async def query_stash_by_ratingKey(ratingKey: str) -> dict | None:
+    if not ratingKey:
+        return None
+    scene_id = _rating_key_scene_id(ratingKey)
+    if scene_id is None:
+        return None
+    return await parse_stash_response("id", int(scene_id))
+
+
+# ---------------------------------------------------------------------------
+# Plex endpoints
+# ---------------------------------------------------------------------------
+# The provider manifest never changes at runtime, so serialize it once at
+# import instead of rebuilding and re-encoding the dict per discovery ping.
+_MEDIA_PROVIDER_BYTES = orjson.dumps(
+    {
+        "MediaProvider": {
+            "identifier": "tv.plex.agents.custom.stash",
+            "title": "Stash Plex Metadata Provider",
+            "version": "1.1.0",
+            "Types": [
+                {
+                    "type": 1,
+                    "Scheme": [{"scheme": "tv.plex.agents.custom.stash"}],
+                },
+            ],
+            "Feature": [
+                {"type": "metadata", "key": "/library/metadata"},
+                {"type": "match", "key": "/library/metadata/matches"},
+            ],
+        }
+    }
+)
+
+# Static headers to go with the static body; built once like the bytes.
+_MEDIA_PROVIDER_HEADERS = {
+    "X-Plex-Client-Identifier": "stash.plex.provider.metadata",
+}
+
+
+@app.get("/")
+async def root():
+    return Response(
+        content=_MEDIA_PROVIDER_BYTES,
+        media_type="application/json",
+        headers=_MEDIA_PROVIDER_HEADERS,
+    )
+
+
+@app.post("/library/metadata/matches")
+async def library_metadata_matches(request: Request):
+    body = await request.json()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Match request body:\n%s", orjson.dumps(body, option=orjson.OPT_INDENT_2).decode())
+
+    # Plex may request certain elements be excluded from the response
+    exclude_elements = {
+        e.strip() for e in (body.get("excludeElements") or "").split(",") if e.strip()
+    }
+
+    filename = body.get("filename")
+    if filename:
+        result = await query_stash_by_filename(filename)
+        if result and exclude_elements:
+            for item in result.get("MediaContainer", {}).get("Metadata", []):
+                for element in exclude_elements:
+                    item.pop(element, None)
+        if result:
+            return result
+    return _EMPTY_CONTAINER
+
+
+@app.get("/library/metadata/{ratingKey}")
+async def get_metadata(ratingKey: str, background_tasks: BackgroundTasks):
+    logger.debug("Fetching metadata for ratingKey: %s", ratingKey)
+    result = await query_stash_by_ratingKey(ratingKey)
+    if result and plex_upload_enabled:
+        metadata_list = result.get("MediaContainer", {}).get("Metadata", [])
+        if metadata_list:
+            title = metadata_list[0].get("title", "")
+            scene_id = _rating_key_scene_id(ratingKey)
+            if scene_id and title:
+                background_tasks.add_task(
+                    _upload_poster_to_plex, scene_id, title
+                )
+    if result:
+        return result
+    # A scene that isn't in Stash won't appear within the TTL either; an
+    # explicit cacheable 404 lets Plex (or any proxy in front) hold the
+    # negative result instead of re-asking, where an empty-but-200
+    # MediaContainer invites retries.
+    return Response(
+        status_code=404, headers={"Cache-Control": "public, max-age=300"}
+    )
+
+
+@app.get("/library/metadata/{ratingKey}/extras")
+async def get_metadata_extras(ratingKey: str):
+    return _EMPTY_CONTAINER
+
+
+# ---------------------------------------------------------------------------
+# Image proxy – Plex fetches images through us so it doesn't need LAN access
+# to Stash directly (images.plex.tv cannot reach private addresses).
+# ---------------------------------------------------------------------------
+# The poster endpoint does blocking PIL work; running it inline in an async
+# endpoint would stall the event loop and serialize every concurrent image
+# request. A bounded pool keeps it off-loop. The raw proxies stream
+# asynchronously and don't need it.
+_image_pool = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="imageproxy"
+)
+
+# Shared image response headers; matches the poster cache TTL below
+_IMAGE_CACHE_HEADERS = {"Cache-Control": "public, max-age=86400"}
+
+@app.get("/stash/scene/{scene_id}/screenshot")
+async def proxy_scene_screenshot(scene_id: str):
+    """Proxy a scene screenshot from Stash."""
+    return await _proxy_stash_image(f"{stash_host}/scene/{scene_id}/screenshot")
+
+
+@app.get("/stash/performer/{performer_id}/image")
+async def proxy_performer_image(performer_id: str):
+    """Proxy a performer image from Stash."""
+    return await _proxy_stash_image(f"{stash_host}/performer/{performer_id}/image")
+
+
+@app.get("/stash/group/{group_id}/front")
+async def proxy_group_front_image(group_id: str):
+    """Proxy a group front image from Stash."""
+    return await _proxy_stash_image(f"{stash_host}/group/{group_id}/front_image")
+
+
+@app.get("/stash/scene/{scene_id}/poster")
+async def proxy_scene_poster(scene_id: str):
+    """Fetch screenshot from Stash and reformat to 2:3 poster with black bars."""
+    poster_bytes = await asyncio.get_running_loop().run_in_executor(
+        _image_pool, _generate_poster_bytes, scene_id
+    )
+    if poster_bytes is None:
+        return Response(status_code=502, content=b"Image processing error")
+    return Response(
+        content=poster_bytes,
+        media_type="image/jpeg",
+        headers={**_IMAGE_CACHE_HEADERS, "Content-Length": str(len(poster_bytes))},
+    )
+
+
+async def _proxy_stash_image(stash_url: str) -> Response:
+    """Stream an image from Stash straight through to the client.
+
+    Bytes are piped from Stash's socket to Plex's as they arrive instead
+    of staging the whole image in memory first, so peak memory per
+    in-flight request is one chunk rather than the full image and the
+    first byte reaches Plex sooner.
+    """
+    request = _stash_async_client.build_request(
+        "GET", stash_url, headers=_stash_image_headers
+    )
+    try:
+        resp = await _stash_async_client.send(request, stream=True)
+    except httpx.HTTPError as e:
+        logger.error("Image proxy failed for %s: %s", stash_url, e)
+        return Response(status_code=502, content=b"Bad Gateway")
+    if resp.status_code >= 400:
+        await resp.aclose()
+        logger.error("Image proxy failed for %s: HTTP %d", stash_url, resp.status_code)
+        return Response(status_code=502, content=b"Bad Gateway")
+
+    return StreamingResponse(
+        resp.aiter_raw(),
+        media_type=resp.headers.get("Content-Type", "image/jpeg"),
+        headers=_IMAGE_CACHE_HEADERS,
+        # Release the connection back to the pool once the body is sent
+        background=BackgroundTask(resp.aclose),
+    )
+
+
+POSTER_WIDTH = 600   # px – produces a 600x900 poster (2:3 aspect ratio)
+POSTER_HEIGHT = 900
+
+# On-disk poster cache – a repeat poster request becomes a file read instead
+# of screenshot download + PIL decode + LANCZOS resize + JPEG encode. Stale
+# entries are revalidated against Stash with If-None-Match when it sends an
+# ETag. Set the dir to "" to disable.
+POSTER_CACHE_TTL = 86400  # matches the Cache-Control max-age we serve
+poster_cache_dir = os.getenv(
+    "POSTER_CACHE_DIR", SERVER_CFG.get("poster_cache_dir", "poster_cache")
+)
+
+
+def _poster_cache_read(cache_path: str) -> bytes | None:
+    try:
+        with open(cache_path, "rb") as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def _poster_cache_write(cache_path: str, data: bytes, etag: str | None) -> None:
+    """Atomically store poster bytes (and the upstream ETag) on disk."""
+    try:
+        os.makedirs(poster_cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp_path, cache_path)
+        if etag:
+            with open(tmp_path, "w") as fh:
+                fh.write(etag)
+            os.replace(tmp_path, cache_path + ".etag")
+    except OSError as e:
+        logger.warning("Poster cache write failed for %s: %s", cache_path, e)
+
+
+def _generate_poster_bytes(scene_id: str) -> bytes | None:
+    """Fetch scene screenshot from Stash and return 2:3 poster JPEG bytes."""
+    cache_path = os.path.join(poster_cache_dir, f"{scene_id}.jpg") if poster_cache_dir else ""
+    have_stale = False
+    if cache_path:
+        try:
+            if time.time() - os.path.getmtime(cache_path) < POSTER_CACHE_TTL:
+                data = _poster_cache_read(cache_path)
+                if data is not None:
+                    return data
+            have_stale = True
+        except OSError:
+            pass
+
+    stash_url = f"{stash_host}/scene/{scene_id}/screenshot"
+    headers = _stash_image_headers
+    if have_stale:
+        etag = _poster_cache_read(cache_path + ".etag")
+        if etag:
+            headers = {**headers, "If-None-Match": etag.decode()}
+    try:
+        resp = _stash_session.get(stash_url, headers=headers, timeout=10)
+        if resp.status_code == 304 and have_stale:
+            # Screenshot unchanged upstream – refresh the entry's age and
+            # serve the cached poster without re-encoding.
+            os.utime(cache_path)
+            return _poster_cache_read(cache_path)
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.error("Poster fetch failed for scene %s: %s", scene_id, e)
+        return None
+
+    try:
+        src = Image.open(io.BytesIO(resp.content))
+        # Let the JPEG decoder DCT-downscale while decoding: for large
+        # screenshots this cuts decode cost ~4x before we touch a pixel.
+        src.draft("RGB", (POSTER_WIDTH * 2, POSTER_HEIGHT * 2))
+        src_w, src_h = src.size
+        if abs(src_w / src_h - POSTER_WIDTH / POSTER_HEIGHT) < 0.02:
+            # Source is already (near) 2:3 – resize straight to target and
+            # skip the canvas + paste; no bars needed.
+            poster = src.resize((POSTER_WIDTH, POSTER_HEIGHT), Image.BILINEAR)
+            if poster.mode != "RGB":
+                poster = poster.convert("RGB")
+        else:
+            scaled_h = int(src_h * POSTER_WIDTH / src_w)
+            src = src.resize((POSTER_WIDTH, scaled_h), Image.BILINEAR)
+            poster = Image.new("RGB", (POSTER_WIDTH, POSTER_HEIGHT), (0, 0, 0))
+            poster.paste(src, (0, (POSTER_HEIGHT - scaled_h) // 2))
+        buf = io.BytesIO()
+        poster.save(buf, format="JPEG", quality=85)
+        data = buf.getvalue()
+        if cache_path:
+            _poster_cache_write(cache_path, data, resp.headers.get("ETag"))
+        return data
+    except Exception as e:
+        logger.error("Poster generation failed for scene %s: %s", scene_id, e)
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Plex poster upload – pushes posters directly to PMS so they're stored
+# locally, bypassing images.plex.tv which can't reach private LAN addresses.
+# ---------------------------------------------------------------------------
+# Scene ids whose poster already landed in PMS. Bounded LRU rather than a
+# bare set so the dedup memory stays capped over long uptimes; uploads run
+# on the BackgroundTasks thread pool, hence the lock.
+_UPLOADED_CAP = 10_000
+_uploaded_posters: "collections.OrderedDict[str, None]" = collections.OrderedDict()
+_uploaded_lock = threading.Lock()
+
+# Fixed headers for the poster upload POST (body is raw JPEG bytes)
+_POSTER_UPLOAD_HEADERS = {"Content-Type": "application/octet-stream"}
+
+
+def _poster_already_uploaded(scene_id: str) -> bool:
+    with _uploaded_lock:
+        if scene_id in _uploaded_posters:
+            _uploaded_posters.move_to_end(scene_id)
+            return True
+    return False
+
+
+def _mark_poster_uploaded(scene_id: str) -> None:
+    with _uploaded_lock:
+        _uploaded_posters[scene_id] = None
+        if len(_uploaded_posters) > _UPLOADED_CAP:
+            _uploaded_posters.popitem(last=False)
+
+
+# Library sections change hours apart at best; don't ask PMS again for
+# every poster upload.
+_PMS_SECTIONS_TTL = 3600
+
+
+def _get_pms_movie_section_keys() -> list[str]:
+    """Get keys of all movie-type library sections from PMS (TTL-cached)."""
+    cached = _cache_get("pms:sections")
+    if cached is not None:
+        return cached["keys"]
+    try:
+        resp = _plex_session.get(f"{plex_url}/library/sections", timeout=10)
+        resp.raise_for_status()
+        data = orjson.loads(resp.content)
+        keys = []
+        for directory in data.get("MediaContainer", {}).get("Directory", []):
+            if directory.get("type") == "movie":
+                keys.append(directory["key"])
+        logger.debug("PMS movie library sections: %s", keys)
+        _cache_set("pms:sections", {"keys": keys}, ttl=_PMS_SECTIONS_TTL)
+        return keys
+    except Exception as e:
+        logger.warning("Failed to get PMS library sections: %s", e)
+        return []
+
+
+# Section key that last produced a hit. Items from one Stash instance
+# almost always land in the same PMS library, so trying it first turns
+# the common case into a single request instead of a full section sweep.
+_last_hit_section: str | None = None
+
+
+def _search_pms_sections(section_keys: list[str], title: str, guid: str) -> str | None:
+    """Search PMS library sections once for an item matching the given GUID."""
+    global _last_hit_section
+    if _last_hit_section in section_keys and section_keys[0] != _last_hit_section:
+        section_keys = [_last_hit_section] + [
+            k for k in section_keys if k != _last_hit_section
+        ]
+    for key in section_keys:
+        try:
+            resp = _plex_session.get(
+                f"{plex_url}/library/sections/{key}/all",
+                params={"type": 1, "title": title},
+                timeout=10,
+            )
+            resp.raise_for_status()
+            data = orjson.loads(resp.content)
+            items = data.get("MediaContainer", {}).get("Metadata", [])
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(
+                    "PMS section %s search for '%s': %d results",
+                    key, title, len(items),
+                )
+            for item in items:
+                if item.get("guid") == guid:
+                    _last_hit_section = key
+                    return item.get("ratingKey")
+                for g in item.get("Guid", []):
+                    if g.get("id") == guid:
+                        _last_hit_section = key
+                        return item.get("ratingKey")
+        except Exception as e:
+            logger.warning("PMS section %s search failed: %s", key, e)
+    return None
+
+
+def _upload_poster_to_plex(scene_id: str, title: str):
+    """Background task: find the item in PMS and upload the poster directly."""
+    if _poster_already_uploaded(scene_id):
+        return
+
+    guid = f"plex://movie/stash-video-{scene_id}"
+    section_keys = _get_pms_movie_section_keys()
+    if not section_keys:
+        logger.error("No movie library sections found in PMS")
+        return
+
+    # Try immediately — item already exists for refreshes
+    pms_key = _search_pms_sections(section_keys, title, guid)
+    if pms_key:
+        logger.info("PMS item found immediately for scene %s (refresh)", scene_id)
+    else:
+        # New item — wait for PMS to finish ingesting, then retry with
+        # exponential backoff. Fast ingests (common on local disks) are
+        # caught within 1-2s instead of the old flat 5s polls, while slow
+        # ones still get ~32s total before giving up.
+        logger.debug("PMS item not found yet for scene %s, waiting for PMS to ingest...", scene_id)
+        delays = (1, 1, 2, 4, 8, 16)
+        for attempt, delay in enumerate(delays, start=1):
+            time.sleep(delay)
+            pms_key = _search_pms_sections(section_keys, title, guid)
+            if pms_key:
+                break
+            logger.debug(
+                "PMS item not found (attempt %d/%d), backing off...",
+                attempt, len(delays),
+            )
+
+    if not pms_key:
+        logger.error("PMS item not found for scene %s (GUID: %s)", scene_id, guid)
+        return
+
+    logger.debug("Found PMS ratingKey %s for scene %s", pms_key, scene_id)
+
+    poster_bytes = _generate_poster_bytes(scene_id)
+    if poster_bytes is None:
+        return
+
+    try:
+        resp = _plex_session.post(
+            f"{plex_url}/library/metadata/{pms_key}/posters",
+            data=poster_bytes,
+            headers=_POSTER_UPLOAD_HEADERS,
+            timeout=30,
+        )
+        resp.raise_for_status()
+        logger.info("Uploaded poster to PMS for scene %s (PMS key: %s)", scene_id, pms_key)
+        _mark_poster_uploaded(scene_id)
+    except Exception as e:
+        logger.error("Failed to upload poster to PMS for scene %s: %s", scene_id, e)
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}